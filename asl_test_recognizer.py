@@ -1,9 +1,12 @@
 from unittest import TestCase
 
+import numpy as np
+from hmmlearn.hmm import GaussianHMM
+
 from asl_data import AslDb
 from asl_utils import train_all_words
 from my_model_selectors import SelectorConstant
-from my_recognizer import recognize
+from my_recognizer import recognize, _score_per_sequence, _score_diag
 
 FEATURES = ['right-y', 'right-x']
 
@@ -26,3 +29,56 @@ class TestRecognize(TestCase):
         self.assertIsInstance(guesses[0], str, "The guesses are not strings")
         self.assertIsInstance(guesses[-1], str, "The guesses are not strings")
 
+    def test_recognize_matches_model_score(self):
+        probs, _ = recognize(self.models, self.test_set)
+        for i in range(self.test_set.num_items):
+            X, lengths = self.test_set.get_item_Xlengths(i)
+            for word, model in self.models.items():
+                try:
+                    expected = model.score(X, lengths)
+                except (ValueError, AttributeError):
+                    expected = float('-inf')
+                self.assertTrue(np.isclose(probs[i][word], expected),
+                                "Score of {} on item {} differs from model.score".format(word, i))
+
+
+class _XlengthsSet(object):
+    """ minimal stand-in for SinglesData: item id -> (X, lengths) """
+
+    def __init__(self, items):
+        self._hmm_data = dict(enumerate(items))
+
+    def get_all_Xlengths(self):
+        return self._hmm_data
+
+
+class TestScorePerSequence(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(14)
+        self.items = [(rng.randn(n, 2) * 5 + 50, [n]) for n in (7, 12, 20, 31)]
+        self.X = np.vstack([X for X, _ in self.items])
+        self.lengths = [len(X) for X, _ in self.items]
+        self.model = GaussianHMM(3, covariance_type='diag', n_iter=20,
+                                 random_state=14).fit(rng.randn(80, 2) * 5 + 50, [40, 40])
+        self.broken = GaussianHMM(3, covariance_type='diag', n_iter=20,
+                                  random_state=14).fit(rng.randn(80, 2) * 5 + 50, [40, 40])
+        self.broken.transmat_[1] = 0
+
+    def test_scores_match_model_score(self):
+        expected = [self.model.score(X, lengths) for X, lengths in self.items]
+        np.testing.assert_allclose(_score_per_sequence(self.model, self.X, self.lengths), expected)
+        np.testing.assert_allclose(_score_diag(self.model, self.X, self.lengths), expected)
+
+    def test_invalid_model_raises(self):
+        with self.assertRaises(ValueError):
+            self.broken.score(self.X, self.lengths)
+        with self.assertRaises(ValueError):
+            _score_per_sequence(self.broken, self.X, self.lengths)
+        with self.assertRaises(ValueError):
+            _score_diag(self.broken, self.X, self.lengths)
+
+    def test_recognize_invalid_model_is_neg_inf(self):
+        probs, guesses = recognize({'GOOD': self.model, 'BROKEN': self.broken}, _XlengthsSet(self.items))
+        self.assertEqual(guesses, ['GOOD'] * len(self.items))
+        for p in probs:
+            self.assertEqual(p['BROKEN'], float('-inf'))
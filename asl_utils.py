@@ -1,6 +1,8 @@
 from asl_data import SinglesData, WordsData
 import numpy as np
 from IPython.core.display import display, HTML
+from joblib import Parallel, delayed
+from threadpoolctl import threadpool_limits
 
 RAW_FEATURES = ['left-x', 'left-y', 'right-x', 'right-y']
 GROUND_FEATURES = ['grnd-rx', 'grnd-ry', 'grnd-lx', 'grnd-ly']
@@ -42,21 +44,35 @@ def getKey(item):
     return item[1]
 
 
-def train_all_words(training: WordsData, model_selector):
+def _fit_one(word, model_selector, sequences, Xlengths, kwargs):
+    """ select the model for a single word; run inside a joblib worker
+
+    BLAS is limited to one thread so the workers don't oversubscribe the cores
+    """
+    with threadpool_limits(1):
+        return model_selector(sequences, Xlengths, word, **kwargs).select()
+
+
+def train_all_words(training: WordsData, model_selector, n_jobs=-1):
     """ train all words given a training set and selector
 
+    each word is an independent set of HMM fits, so the words are dispatched
+    across n_jobs worker processes, unless the selector sets parallel_words
+    to False because it shares work across words within a process
+
     :param training: WordsData object (training set)
     :param model_selector: class (subclassed from ModelSelector)
+    :param n_jobs: int number of worker processes, -1 for all cores
     :return: dict of models keyed by word
     """
     sequences = training.get_all_sequences()
     Xlengths = training.get_all_Xlengths()
-    model_dict = {}
-    for word in training.words:
-        model = model_selector(sequences, Xlengths, word,
-                               n_constant=3).select()
-        model_dict[word] = model
-    return model_dict
+    kwargs = {'n_constant': 3}
+    if not getattr(model_selector, 'parallel_words', True):
+        n_jobs = 1
+    models = Parallel(n_jobs=n_jobs, backend='loky', batch_size='auto')(
+        delayed(_fit_one)(word, model_selector, sequences, Xlengths, kwargs) for word in training.words)
+    return dict(zip(training.words, models))
 
 
 def combine_sequences(split_index_list, sequences):
@@ -1,50 +1,177 @@
-import math
-import statistics
+import os
+import threading
 import warnings
+from collections import OrderedDict
 
 import numpy as np
 from hmmlearn.hmm import GaussianHMM
+from joblib import Memory, Parallel, cpu_count, delayed, hash as joblib_hash
 from sklearn.model_selection import KFold
+from threadpoolctl import threadpool_limits
 from asl_utils import combine_sequences
 
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+warnings.filterwarnings("ignore", category=RuntimeWarning)
+
+
+def _train_hmm(X, lengths, num_states, random_state, max_iter):
+    """ fit a diagonal covariance GaussianHMM
+
+    :return: GaussianHMM object, or None if the fit failed
+    """
+    try:
+        return GaussianHMM(n_components=num_states, covariance_type="diag", n_iter=max_iter,
+                           tol=1e-2, init_params='stmc',
+                           random_state=random_state, verbose=False).fit(X, lengths)
+    except ValueError:
+        return None
+
+
+def set_hmm_cache(location):
+    """ also cache fitted models on disk under location, or keep them in memory only with None
+
+    joblib workers started by train_all_words read the ASL_HMM_CACHE
+    environment variable instead, so set that to share the disk cache with them
+
+    :param location: str directory or None
+    """
+    global hmm_cache, _cached_train_hmm
+    hmm_cache = Memory(location=location, verbose=0)
+    _cached_train_hmm = hmm_cache.cache(_train_hmm)
+
+
+# disk cache is off unless ASL_HMM_CACHE names a directory; clear with hmm_cache.clear()
+set_hmm_cache(os.environ.get('ASL_HMM_CACHE'))
+
+# in-process LRU of fitted models keyed by joblib.hash of the fit arguments
+_FIT_MEMO_SIZE = 4096
+_fit_memo = OrderedDict()
+_fit_memo_lock = threading.Lock()
+
+
+def _fit_hmm(X, lengths, num_states, random_state, max_iter):
+    """ fit a diagonal covariance GaussianHMM, reusing an earlier identical fit
+
+    fits are keyed on their arguments, including the contents of X, so the same
+    fit requested by different selectors is only trained once per process, and
+    once across runs when the disk cache is enabled
+
+    :return: GaussianHMM object, or None if the fit failed
+    """
+    key = joblib_hash((X, list(lengths), num_states, random_state, max_iter))
+    with _fit_memo_lock:
+        if key in _fit_memo:
+            _fit_memo.move_to_end(key)
+            return _fit_memo[key]
+    model = _cached_train_hmm(X, lengths, num_states, random_state, max_iter)
+    with _fit_memo_lock:
+        _fit_memo[key] = model
+        if len(_fit_memo) > _FIT_MEMO_SIZE:
+            _fit_memo.popitem(last=False)
+    return model
+
+
+def _guarded_fit(X, lengths, num_states, random_state, max_iter, X_finite):
+    """ _fit_hmm, short-circuited for data Baum-Welch can't fit sensibly
+
+    :param X_finite: bool, whether every value in X is finite (computed once by the caller)
+    :return: GaussianHMM object, or None without fitting when there are fewer than
+        two frames per state or X has non-finite values
+    """
+    if len(X) < num_states * 2 or not X_finite:
+        return None
+    return _fit_hmm(X, lengths, num_states, random_state, max_iter)
+
+
+def _fold_score(X_train, lengths_train, X_test, lengths_test, num_states, random_state, max_iter, X_finite):
+    """ held-out log likelihood of a model fit on one CV fold """
+    model = _guarded_fit(X_train, lengths_train, num_states, random_state, max_iter, X_finite)
+    return model.score(X_test, lengths_test)
+
 
 class ModelSelector(object):
     '''
     base class for model selection (strategy design pattern)
     '''
 
+    # whether train_all_words may select words in separate worker processes
+    parallel_words = True
+
     def __init__(self, all_word_sequences: dict, all_word_Xlengths: dict, this_word: str,
                  n_constant=3,
                  min_n_components=2, max_n_components=10,
-                 random_state=14, verbose=False):
+                 random_state=14, verbose=False, max_iter=50):
         self.words = all_word_sequences
         self.hwords = all_word_Xlengths
         self.sequences = all_word_sequences[this_word]
         self.X, self.lengths = all_word_Xlengths[this_word]
+        self.X = np.ascontiguousarray(self.X, dtype=np.float64)
+        self.X_finite = bool(np.isfinite(self.X).all())
         self.this_word = this_word
         self.n_constant = n_constant
         self.min_n_components = min_n_components
         self.max_n_components = max_n_components
         self.random_state = random_state
         self.verbose = verbose
+        self.max_iter = max_iter
 
     def select(self):
         raise NotImplementedError
 
     def base_model(self, num_states):
-        # with warnings.catch_warnings():
-        warnings.filterwarnings("ignore", category=DeprecationWarning)
-        # warnings.filterwarnings("ignore", category=RuntimeWarning)
-        try:
-            hmm_model = GaussianHMM(n_components=num_states, covariance_type="diag", n_iter=1000,
-                                    random_state=self.random_state, verbose=False).fit(self.X, self.lengths)
-            if self.verbose:
-                print("model created for {} with {} states".format(self.this_word, num_states))
-            return hmm_model
-        except:
-            if self.verbose:
+        hmm_model = _guarded_fit(self.X, self.lengths, num_states, self.random_state, self.max_iter,
+                                 self.X_finite)
+        if self.verbose:
+            if hmm_model is None:
                 print("failure on {} with {} states".format(self.this_word, num_states))
-            return None
+            else:
+                print("model created for {} with {} states".format(self.this_word, num_states))
+        return hmm_model
+
+
+# only the most recent table is kept: (joblib hash of hwords and params, (words, scores, models))
+_dic_cache = None
+
+
+def _dic_table(hwords, min_n_components, max_n_components, random_state, max_iter):
+    """ fit and score every word for every candidate number of states
+
+    the table only depends on the training set, so it is built once and shared
+    by every SelectorDIC created from the same Xlengths data; it is keyed on the
+    contents of hwords so copies unpickled in joblib workers hit it too
+
+    :return: (list, np.array, dict)
+        words in column order, (S, N) table of logL with nan for failed fits,
+        fitted models keyed by (state index, word index)
+    """
+    global _dic_cache
+    key = joblib_hash((hwords, min_n_components, max_n_components, random_state, max_iter))
+    if _dic_cache is not None and _dic_cache[0] == key:
+        return _dic_cache[1]
+
+    words = list(hwords.keys())
+    data = []
+    for word in words:
+        X, lengths = hwords[word]
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        data.append((X, lengths, bool(np.isfinite(X).all())))
+
+    nums = range(min_n_components, max_n_components+1)
+    scores = np.full((len(nums), len(words)), np.nan)
+    models = {}
+    for si, num in enumerate(nums):
+        for wi, (X, lengths, X_finite) in enumerate(data):
+            model = _guarded_fit(X, lengths, num, random_state, max_iter, X_finite)
+            if model is None:
+                continue
+            try:
+                scores[si, wi] = model.score(X, lengths)
+                models[(si, wi)] = model
+            except ValueError:
+                pass
+
+    _dic_cache = (key, (words, scores, models))
+    return words, scores, models
 
 
 class SelectorConstant(ModelSelector):
@@ -74,25 +201,28 @@ class SelectorBIC(ModelSelector):
 
         :return: GaussianHMM object
         """
-        warnings.filterwarnings("ignore", category=DeprecationWarning)
-
-        # TODO implement model selection based on BIC scores
-        best_score = float('inf')
-        best_model = None
-
-        try:
-            for num in range(self.min_n_components, self.max_n_components+1):
-                model = self.base_model(num)
-                logL = model.score(self.X, self.lengths)
-                p = (num*(num-1) + 2*len(self.X[0])*num)
-                score = -2 * logL + p * np.log(len(self.X))
-                if score < best_score:
-                    best_score = score
-                    best_model = model
-            return best_model
-
-        except:
-            return best_model
+        d = self.X.shape[1]
+        logN = np.log(self.X.shape[0])
+        nums = np.arange(self.min_n_components, self.max_n_components+1)
+        logLs = np.full(len(nums), np.nan)
+        models = [None] * len(nums)
+
+        # fits are serial; failed fits stay nan and are ignored by nanargmin
+        for i, num in enumerate(nums):
+            model = self.base_model(int(num))
+            if model is None:
+                continue
+            try:
+                logLs[i] = model.score(self.X, self.lengths)
+                models[i] = model
+            except ValueError:
+                pass
+
+        if np.isnan(logLs).all():
+            return None
+        p = nums*(nums-1) + 2*d*nums
+        bic = -2 * logLs + p * logN
+        return models[int(np.nanargmin(bic))]
 
 
 class SelectorDIC(ModelSelector):
@@ -105,40 +235,20 @@ class SelectorDIC(ModelSelector):
     DIC = log(P(X(i)) - 1/(M-1)SUM(log(P(X(all but i))
     '''
 
-    def select(self):
-        warnings.filterwarnings("ignore", category=DeprecationWarning)
-
-        # TODO implement model selection based on DIC scores
-        best_score = float('-inf')
-        best_model = None
+    # the all-words score table would be rebuilt in every worker process
+    parallel_words = False
 
-        for num in range(self.min_n_components, self.max_n_components+1):
-            logP1 = {}
-            words = []
-            for train in self.words.keys():
-                X_train, lengths_train = self.hwords[train]
-                try:
-                    model = GaussianHMM(num, covariance_type='diag', n_iter=1000,
-                                        random_state=self.random_state,
-                                        verbose=self.verbose).fit(X_train, lengths_train)
-                    logP1[train] = model.score(X_train, lengths_train)
-                    words.append(train)
-
-                except ValueError:
-                    pass
-
-                try:
-                    if len(words) > 1:
-                        logP2 = sum([logP1[word] for word in words if word != self.this_word])
-                        score = logP1[self.this_word] - (1/(len(words)-1)) * logP2
-                        if score > best_score:
-                            best_score = score
-                            best_model = model
-
-                except KeyError:
-                    best_model = model
-
-        return best_model
+    def select(self):
+        words, scores, models = _dic_table(self.hwords, self.min_n_components, self.max_n_components,
+                                           self.random_state, self.max_iter)
+        wi = words.index(self.this_word)
+        # the mean over all other words is (row total - this word) / (words fitted in the row - 1)
+        row_sum = np.nansum(scores, axis=1)
+        n_valid = np.sum(~np.isnan(scores), axis=1)
+        dic = scores[:, wi] - (row_sum - scores[:, wi]) / np.maximum(n_valid - 1, 1)
+        if np.isnan(dic).all():
+            return None
+        return models[(int(np.nanargmax(dic)), wi)]
 
 
 class SelectorCV(ModelSelector):
@@ -147,47 +257,42 @@ class SelectorCV(ModelSelector):
     '''
 
     def select(self):
-        warnings.filterwarnings("ignore", category=DeprecationWarning)
+        # a single sequence can't be split into folds, so fall back to the constant model
+        if len(self.sequences) < 2:
+            return self.base_model(self.n_constant)
 
-        # TODO implement model selection using CV
         best_score = float('-inf')
         best_model = None
         kfold_n = min(3, len(self.sequences))
-
-        if kfold_n == 1:
+        # the splits don't depend on num, so build the fold data once
+        folds = []
+        for cv_train, cv_test in KFold(kfold_n).split(self.sequences):
+            X_train, lengths_train = combine_sequences(cv_train, self.sequences)
+            X_test, lengths_test = combine_sequences(cv_test, self.sequences)
+            folds.append((np.asarray(X_train, dtype=np.float64), lengths_train,
+                          np.asarray(X_test, dtype=np.float64), lengths_test))
+
+        # the folds of each num are fit on parallel threads; BLAS is held to one
+        # thread so the fits don't oversubscribe the cores
+        best_num = None
+        with threadpool_limits(1), Parallel(n_jobs=min(kfold_n, cpu_count()), prefer='threads') as parallel:
             for num in range(self.min_n_components, self.max_n_components+1):
-                model = self.base_model(num)
                 try:
-                    score = model.score(self.X, self.lengths)
-                    if score > best_score:
-                        best_score = score
-                        best_model = model
-
-                except:
-                    pass
-
-        else:
-            split_method = KFold(kfold_n)
-            for num in range(self.min_n_components, self.max_n_components+1):
-                try:
-                    log_sum = 0
-                    length = 0
-                    for cv_train, cv_test in split_method.split(self.sequences):
-                        X_train, lengths_train = combine_sequences(cv_train, self.sequences)
-                        X_test, lengths_test = combine_sequences(cv_test, self.sequences)
-                        model = GaussianHMM(num, covariance_type='diag', n_iter=1000,
-                                        random_state=self.random_state,
-                                        verbose=self.verbose).fit(X_train, lengths_train)
-                        score = model.score(X_test, lengths_test)
-                        log_sum += score
-                        length += 1
-
-                    avg_score = log_sum / length
+                    scores = parallel(
+                        delayed(_fold_score)(*fold, num, self.random_state, self.max_iter, self.X_finite)
+                        for fold in folds)
+                    if not scores:
+                        continue
+                    avg_score = np.mean(scores)
                     if avg_score > best_score:
                         best_score = avg_score
-                        best_model = model
+                        best_num = num
 
-                except:
+                except (ValueError, AttributeError):
                     pass
 
-        return best_model
\ No newline at end of file
+        # the fold models only saw part of the data, so refit the winner on all of it;
+        # base_model goes through the _fit_hmm memo, so BIC/DIC reuse this same fit
+        if best_num is not None:
+            best_model = self.base_model(best_num)
+        return best_model
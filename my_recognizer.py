@@ -1,6 +1,114 @@
 import warnings
+
+import numpy as np
+from hmmlearn import _hmmc
 from asl_data import SinglesData
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+warnings.filterwarnings("ignore", category=RuntimeWarning)
+
+
+def _score_per_sequence(model, X, lengths):
+    """ log likelihood of each sequence in X under model
+
+    like model.score, but the emission log likelihoods of all frames are
+    computed in a single call and the forward pass is run per sequence
+
+    :param model: GaussianHMM object
+    :param X: np.array of concatenated sequences
+    :param lengths: list of sequence lengths within X
+    :return: np.array of log likelihoods, one per sequence
+    """
+    model._check()  # raises ValueError for an invalid model, as model.score does
+    framelogprob = model._compute_log_likelihood(X)
+    bounds = np.cumsum([0] + list(lengths))
+    scores = np.empty(len(lengths))
+    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        if hasattr(model, '_do_forward_pass'):  # hmmlearn < 0.3
+            scores[i] = model._do_forward_pass(framelogprob[start:end])[0]
+        else:
+            scores[i] = _hmmc.forward_log(model.startprob_, model.transmat_, framelogprob[start:end])[0]
+    return scores
+
+
+def _logsumexp(a):
+    a_max = a.max()
+    if a_max == -np.inf:
+        return a_max
+    return a_max + np.log(np.exp(a - a_max).sum())
+
+
+def _diag_forward(X, bounds, means, inv_vars, log_norm, log_startprob, log_transmat):
+    """ forward algorithm log likelihood of each sequence of a diagonal Gaussian HMM
+
+    the emission log density of each frame is computed inside the recursion
+    instead of being materialized as a frames x states matrix
+
+    :param X: np.array of concatenated sequences
+    :param bounds: np.array of sequence start offsets in X, plus len(X)
+    :return: np.array of log likelihoods, one per sequence
+    """
+    n_states, n_features = means.shape
+    scores = np.empty(len(bounds) - 1)
+    alpha = np.empty(n_states)
+    new_alpha = np.empty(n_states)
+    work = np.empty(n_states)
+    for s in range(len(bounds) - 1):
+        for t in range(bounds[s], bounds[s+1]):
+            for j in range(n_states):
+                emit = log_norm[j]
+                for d in range(n_features):
+                    diff = X[t, d] - means[j, d]
+                    emit -= 0.5 * diff * diff * inv_vars[j, d]
+                if t == bounds[s]:
+                    new_alpha[j] = log_startprob[j] + emit
+                else:
+                    for i in range(n_states):
+                        work[i] = alpha[i] + log_transmat[i, j]
+                    new_alpha[j] = _logsumexp(work) + emit
+            alpha[:] = new_alpha
+        scores[s] = _logsumexp(alpha)
+    return scores
+
+
+if njit is not None:
+    _logsumexp = njit(cache=True)(_logsumexp)
+    _diag_forward = njit(cache=True)(_diag_forward)
+
+
+def _score_diag(model, X, lengths):
+    """ log likelihood of each sequence in X under a diagonal covariance GaussianHMM
+
+    same result as _score_per_sequence, computed by the compiled _diag_forward
+
+    :param model: GaussianHMM object with covariance_type 'diag'
+    :param X: np.array of concatenated sequences
+    :param lengths: list of sequence lengths within X
+    :return: np.array of log likelihoods, one per sequence
+    """
+    model._check()  # raises ValueError for an invalid model, as model.score does
+    n_features = model.means_.shape[1]
+    bounds = np.cumsum([0] + list(lengths))
+    # the compiled kernel doesn't bounds-check, so reject input hmmlearn would reject
+    if X.ndim != 2 or X.shape[1] != n_features:
+        raise ValueError("expected X with {} features, got shape {}".format(n_features, X.shape))
+    if bounds[-1] != len(X):
+        raise ValueError("lengths sum to {} but X has {} frames".format(bounds[-1], len(X)))
+    covars = model.covars_
+    if covars.ndim == 3:  # hmmlearn exposes diagonal covariances as full matrices
+        covars = np.diagonal(covars, axis1=1, axis2=2)
+    log_norm = -0.5 * (n_features * np.log(2 * np.pi) + np.log(covars).sum(axis=1))
+    with np.errstate(divide='ignore'):
+        log_startprob = np.log(model.startprob_)
+        log_transmat = np.log(model.transmat_)
+    return _diag_forward(X, bounds, np.ascontiguousarray(model.means_), 1.0 / covars, log_norm,
+                         log_startprob, log_transmat)
+
 
 def recognize(models: dict, test_set: SinglesData):
     """ Recognize test word sequences from word models set
@@ -17,32 +125,35 @@ def recognize(models: dict, test_set: SinglesData):
        guesses is a list of the best guess words ordered by the test set word_id
            ['WORDGUESS0', 'WORDGUESS1', 'WORDGUESS2',...]
    """
-    warnings.filterwarnings("ignore", category=DeprecationWarning)
-    probabilities = []
-    guesses = ['' for i in range(len(test_set.get_all_Xlengths()))]
-    # TODO implement the recognizer
-    # return probabilities, guesses
-    for i in range(len(test_set.get_all_sequences())):
-        current_sequence = test_set.get_item_sequences(i)
-        current_X, current_lengths = test_set.get_item_Xlengths(i)
-        best_word = None
-        p = {}
-        best_score = float('-inf')
-
-        for word in models:
-            model = models[word]
-            try:
-                score = model.score(current_X, current_lengths)
-                p[word] = score
-            except:
-                p[word] = 0
-
-            if score > best_score:
-                best_score = score
-                best_word = word
-
-        probabilities.append(p)
-        guesses[i] = best_word
-
-
-    return probabilities, guesses
\ No newline at end of file
+    words = list(models.keys())
+    xlengths_all = test_set.get_all_Xlengths()
+    n = len(xlengths_all)
+    if n == 0:
+        return [], []
+    guesses = [None] * n
+    # every item is stacked into one array so each model is scored in a single pass
+    Xs = [np.ascontiguousarray(xlengths_all[i][0], dtype=np.float64) for i in range(n)]
+    X_all = np.vstack(Xs)
+    lens_all = [len(X) for X in Xs]
+
+    # scores[word index, item index]; models that failed to train or score stay -inf
+    scores = np.full((len(words), n), -np.inf)
+    for wi, word in enumerate(words):
+        model = models[word]
+        if model is None:
+            continue
+        try:
+            if njit is not None and model.covariance_type == 'diag':
+                scores[wi] = _score_diag(model, X_all, lens_all)
+            else:
+                scores[wi] = _score_per_sequence(model, X_all, lens_all)
+        except ValueError:
+            pass
+
+    probabilities = [dict(zip(words, scores[:, i].tolist())) for i in range(n)]
+    if words:
+        # an item no model could score keeps its None guess
+        scored = np.isfinite(scores).any(axis=0)
+        guesses = [words[wi] if ok else None for wi, ok in zip(scores.argmax(axis=0), scored)]
+
+    return probabilities, guesses